@@ -7,14 +7,21 @@ KPI App – Định Hóa (v3.22)
 - Tổng điểm KPI (tạm tính)
 """
 
-import re, io, base64, math, ast
+import re, io, base64, math, random, uuid
 from pathlib import Path
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import streamlit as st
 import gspread
+from gspread.utils import numericise_all
 from google.oauth2.service_account import Credentials
 
+import kpi_core
+from kpi_core import (KPI_COLS, NUMERIC_COLS, RULES_DEFAULT, normalize_columns, format_vn_number,
+                      parse_vn_number, parse_float, coerce_numeric_cols, rules_from_frame, match_rule,
+                      df_to_report_bytes, generate_pdf_from_df)
+
 # Drive API (tùy chọn)
 try:
     from googleapiclient.discovery import build as gbuild
@@ -39,6 +46,7 @@ defaults = {
     "_selected_idx": None,
     "_csv_loaded_sig": "",
     "auto_save_drive": False,
+    "kpi_partitioned": False,
 }
 for k, v in defaults.items():
     if k not in st.session_state:
@@ -76,6 +84,20 @@ def get_gs_clients():
         st.session_state["_gs_error"] = f"SECRETS_ERROR: {e}"
         return None, None
 
+class _TitledSpreadsheet(gspread.Spreadsheet):
+    """Giữ tên các sheet từ lần lấy metadata ngay khi mở (Spreadsheet.__init__) để khỏi gọi lại API."""
+    _titles = None
+    def fetch_sheet_metadata(self, params=None):
+        meta = super().fetch_sheet_metadata(params)
+        if "sheets" in meta: self._titles = [s["properties"]["title"] for s in meta["sheets"]]
+        return meta
+    def sheet_titles(self, refresh: bool = False):
+        # Danh sách từ lần mở chỉ dùng 1 lần; các lần sau (hoặc refresh) lấy metadata mới
+        if refresh or self._titles is None:
+            self.fetch_sheet_metadata(params={"fields": "sheets.properties.title"})
+        titles, self._titles = self._titles, None
+        return titles
+
 def open_spreadsheet(sid_or_url: str):
     sid = extract_sheet_id(sid_or_url or GOOGLE_SHEET_ID_DEFAULT) or GOOGLE_SHEET_ID_DEFAULT
     gclient, creds = st.session_state.get("_gs_pair", (None, None))
@@ -84,292 +106,96 @@ def open_spreadsheet(sid_or_url: str):
         st.session_state["_gs_pair"] = (gclient, creds)
     if gclient is None:
         raise RuntimeError("Chưa cấu hình service account trong st.secrets.")
-    return gclient.open_by_key(sid)
-
-def df_from_ws(ws) -> pd.DataFrame:
-    records = ws.get_all_records(expected_headers=ws.row_values(1))
-    return pd.DataFrame(records)
-
-ALIAS = {
-    "USE (mã đăng nhập)": ["USE (mã đăng nhập)", r"Tài khoản (USE\\username)", "Tài khoản (USE/username)", "Tài khoản", "Username", "USE", "User"],
-    "Mật khẩu mặc định": ["Mật khẩu mặc định", "Password mặc định", "Password", "Mật khẩu"],
-    "Tên chỉ tiêu (KPI)": ["Tên chỉ tiêu (KPI)", "Tên KPI", "Chỉ tiêu"],
-    "Đơn vị tính": ["Đơn vị tính", "Unit"],
-    "Kế hoạch": ["Kế hoạch", "Plan", "Target", "Kế hoạch (tháng)"],
-    "Thực hiện": ["Thực hiện", "Thực hiện (tháng)", "Actual (month)"],
-    "Trọng số": ["Trọng số", "Weight"],
-    "Bộ phận/người phụ trách": ["Bộ phận/người phụ trách", "Phụ trách"],
-    "Tháng": ["Tháng", "Month"],
-    "Năm": ["Năm", "Year"],
-    "Điểm KPI": ["Điểm KPI", "Score"],
-    "Ghi chú": ["Ghi chú", "Notes"],
-    "Tên đơn vị": ["Tên đơn vị", "Đơn vị"],
-    "Phương pháp đo kết quả": ["Phương pháp đo kết quả", "Cách tính", "Công thức"],
-    "Ngưỡng dưới": ["Ngưỡng dưới", "Min"],
-    "Ngưỡng trên": ["Ngưỡng trên", "Max"],
-}
-def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
-    if df is None or df.empty: return df
-    cols_lower = {c.strip().lower(): c for c in df.columns}
-    rename = {}
-    for std, cands in ALIAS.items():
-        if std in df.columns: continue
-        for c in cands:
-            key = c.strip().lower()
-            if key in cols_lower:
-                rename[cols_lower[key]] = std
-                break
-    if rename: df = df.rename(columns=rename)
-    if "Thực hiện (tháng)" in df.columns and "Thực hiện" not in df.columns:
-        df = df.rename(columns={"Thực hiện (tháng)":"Thực hiện"})
-    if "Kế hoạch (tháng)" in df.columns and "Kế hoạch" not in df.columns:
-        df = df.rename(columns={"Kế hoạch (tháng)":"Kế hoạch"})
-    return df
-
-def format_vn_number(x, decimals=2):
-    try: f = float(x)
-    except Exception: return ""
-    s = f"{f:,.{decimals}f}"
-    return s.replace(",", "_").replace(".", ",").replace("_", ".")
-
-def parse_vn_number(s):
-    if s is None: return None
-    txt = str(s).strip()
-    if txt == "" or txt.lower() in ("none", "nan"): return None
-    txt = txt.replace(".", "").replace(",", ".")
-    try: return float(txt)
-    except Exception: return None
-
-def parse_float(x):
-    if isinstance(x,(int,float)): return float(x)
-    return parse_vn_number(x)
-
-def to_percent(val):
-    v = parse_float(val)
-    if v is None: return None
-    return v*100.0 if abs(v)<=1.0 else v
-
-# ===================== RULE ENGINE (tóm lược) =====================
+    opened = st.session_state.setdefault("_sh_cache", {})
+    if sid not in opened:
+        opened[sid] = _TitledSpreadsheet(gclient.http_client, {"id": sid})
+    return opened[sid]
+
+def df_from_values(values) -> pd.DataFrame:
+    # Dựng DataFrame trực tiếp từ lưới giá trị (hàng 1 = tiêu đề), không qua list dict
+    if not values: return pd.DataFrame()
+    header = [str(h).strip() for h in values[0]]
+    width = len(header)
+    rows = [numericise_all((list(r) + [""]*width)[:width]) for r in values[1:]]
+    return pd.DataFrame(rows, columns=header)
+
+def _a1_sheet(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+USE_HEADERS = ("USE (mã đăng nhập)", "Tài khoản (USE\\username)", "Tài khoản", "Username", "USE")
+PW_HEADERS  = ("Mật khẩu mặc định", "Password", "Mật khẩu")
+def _is_use_header(headers) -> bool:
+    headers = [str(h).strip() for h in headers]
+    return any(h in headers for h in USE_HEADERS) and any(h in headers for h in PW_HEADERS)
+
+def kpi_rev_sheet(kpi_name: str) -> str:
+    return f"{kpi_name}_REV"
+
+def kpi_partition_prefix(kpi_name: str) -> str:
+    return f"{kpi_name} | "
+
+def load_book_frames(force: bool = False) -> dict:
+    """Đọc USE, RULES và bảng phiên bản phân vùng KPI (<KPI>_REV) một lần/phiên.
+    Lần đầu: metadata lấy lúc mở spreadsheet + 1 lần values_batch_get."""
+    sid = extract_sheet_id(st.session_state.get("spreadsheet_id","")) or GOOGLE_SHEET_ID_DEFAULT
+    kpi_name = st.session_state.get("kpi_sheet_name") or KPI_SHEET_DEFAULT
+    book = st.session_state.get("_book_cache")
+    if not force and book and book["key"] == (sid, kpi_name):
+        return book["frames"]
+    sh = open_spreadsheet(sid)
+    titles = sh.sheet_titles(refresh=force)
+    wanted = {"USE": "USE", "RULES": "RULES", "KPI_REV": kpi_rev_sheet(kpi_name)}
+    found = {k: t for k, t in wanted.items() if t in titles}
+    parts = [t for t in titles if t.startswith(kpi_partition_prefix(kpi_name))]
+    # Không có sheet tên USE: dò tiêu đề hàng 1 của các sheet còn lại ngay trong cùng lô
+    probe = [] if "USE" in found else [t for t in titles if t not in found.values() and t not in parts]
+    ranges = [_a1_sheet(t) for t in found.values()] + [f"{_a1_sheet(t)}!1:1" for t in probe]
+    grids = []
+    if ranges:
+        res = sh.values_batch_get(ranges)
+        grids = [vr.get("values", []) for vr in res.get("valueRanges", [])]
+    frames = {k: df_from_values(g) for k, g in zip(found.keys(), grids)}
+    if probe:
+        hit = next((t for t, g in zip(probe, grids[len(found):]) if g and _is_use_header(g[0])), None)
+        if hit:
+            res = sh.values_batch_get([_a1_sheet(hit)])
+            frames["USE"] = df_from_values(res.get("valueRanges", [{}])[0].get("values", []))
+    st.session_state["_book_cache"] = {"key": (sid, kpi_name), "frames": frames}
+    return frames
+
+# ===================== RULE ENGINE (dùng kpi_core) =====================
 _RULES_CACHE = None
-_RULES_DEFAULT = [
-    {"Code":"PENALTY_ERR_004","Type":"PENALTY_ERR","thr":1.5,"step":0.1,"pen":0.04,"cap":3.0,"keywords":"dự báo tổng thương phẩm; sai số ±1,5%; trừ 0,04; tru 0,04"},
-    {"Code":"PENALTY_ERR_002","Type":"PENALTY_ERR","thr":1.5,"step":0.1,"pen":0.02,"cap":3.0,"keywords":"sai số ±1,5%; trừ 0,02; tru 0,02"},
-    {"Code":"PENALTY_FLAG_025","Type":"PENALTY_FLAG","pen":0.25,"keywords":"vượt chỉ tiêu; 0,25; saifi; saidi"},
-    {"Code":"RATIO_UP","Type":"RATIO_UP","keywords":"tăng tốt hơn; >="},
-    {"Code":"RATIO_DOWN","Type":"RATIO_DOWN","keywords":"giảm tốt hơn; <="},
-    {"Code":"PASS_FAIL","Type":"PASS_FAIL","keywords":"đạt/không đạt"},
-    {"Code":"RANGE","Type":"RANGE","keywords":"khoảng; range"},
-]
-def _to_float(x): 
-    try: return float(x)
-    except: return None
-def _coerce_weight(w):
-    w = _to_float(w) or 0.0
-    return w/100.0 if w>1 else max(w,0.0)
-def _safe_eval_expr(expr, env):
-    allowed_names = {"min":min,"max":max,"abs":abs,"round":round,"math":math}
-    allowed_vars  = {k:(v if v is not None else 0.0) for k,v in env.items()}
-    code = ast.parse(expr, mode="eval")
-    for node in ast.walk(code):
-        if isinstance(node, ast.Call):
-            if isinstance(node.func, ast.Name):
-                if node.func.id not in allowed_names: raise ValueError("Func not allowed")
-            elif isinstance(node.func, ast.Attribute):
-                if not (isinstance(node.func.value, ast.Name) and node.func.value.id=="math"):
-                    raise ValueError("Only math.* allowed")
-        elif not isinstance(node,(ast.Expression,ast.BinOp,ast.UnaryOp,ast.Num,ast.Name,ast.Load,
-                                  ast.Add,ast.Sub,ast.Mult,ast.Div,ast.Pow,ast.Mod,ast.FloorDiv,
-                                  ast.USub,ast.UAdd,ast.Call,ast.Attribute,ast.Constant,ast.Compare,
-                                  ast.Gt,ast.Lt,ast.GtE,ast.LtE,ast.Eq,ast.NotEq,ast.BoolOp,ast.And,ast.Or,ast.IfExp)):
-            raise ValueError("Unsafe")
-    return eval(compile(code,"<expr>","eval"),{"__builtins__":{},**allowed_names},allowed_vars)
 def load_rules_registry():
     global _RULES_CACHE
     if _RULES_CACHE is not None: return _RULES_CACHE
     try:
-        sh = open_spreadsheet(st.session_state.get("spreadsheet_id",""))
-        try:
-            ws = sh.worksheet("RULES")
-            recs = ws.get_all_records(expected_headers=ws.row_values(1))
-            rules = []
-            for r in recs:
-                rule = {k.strip(): v for k,v in r.items()}
-                rule["Code"] = str(rule.get("Code") or "").strip()
-                rule["Type"] = str(rule.get("Type") or "").strip().upper()
-                for k in ("thr","step","pen","cap"):
-                    rule[k] = _to_float(rule.get(k)) if (str(rule.get(k) or "")!="") else None
-                for k in ("op","lo","hi"):
-                    rule[k] = rule.get(k) if str(rule.get(k) or "")!="" else None
-                rule["expr"] = str(rule.get("expr") or "").strip()
-                rule["keywords"] = str(rule.get("keywords") or "").lower()
-                if rule["Code"] and rule["Type"]:
-                    rules.append(rule)
-            if rules:
-                _RULES_CACHE = rules
-                return _RULES_CACHE
-        except Exception:
-            pass
+        rules = rules_from_frame(load_book_frames().get("RULES"))
+        if rules:
+            _RULES_CACHE = rules
+            return _RULES_CACHE
     except Exception:
         pass
-    _RULES_CACHE = _RULES_DEFAULT
+    _RULES_CACHE = RULES_DEFAULT
     return _RULES_CACHE
-def _parse_overrides(txt):
-    code, overrides = None, {}
-    m = re.search(r"\[([A-Za-z0-9_]+)\]", str(txt))
-    if m: code = m.group(1).strip().upper()
-    for k,v in re.findall(r"([A-Za-z_]+)\s*=\s*([0-9\.,-]+)", str(txt)):
-        k = k.strip().lower(); v = v.strip().replace(".","").replace(",",".")
-        overrides[k] = _to_float(v) if k!="op" else v
-    mop = re.search(r"op\s*=\s*(<=|>=)", str(txt))
-    if mop: overrides["op"] = mop.group(1)
-    return code, overrides
 def _match_rule(method_text, kpi_name=None):
-    rules = load_rules_registry()
-    txt = (method_text or "").strip()
-    code, overrides = _parse_overrides(txt)
-    if code:
-        for r in rules:
-            if r.get("Code","").upper()==code: return r, overrides
-    t = txt.lower()
-    for r in rules:
-        kw = r.get("keywords","")
-        if any(k.strip() and k.strip() in t for k in kw.split(";")):
-            return r, {}
-    if kpi_name:
-        name = str(kpi_name)
-        if "≤" in name or "<=" in name.lower(): return {"Code":"RATIO_DOWN_AUTO","Type":"RATIO_DOWN"}, {}
-        if "≥" in name or ">=" in name.lower(): return {"Code":"RATIO_UP_AUTO","Type":"RATIO_UP"}, {}
-    return None, {}
-def _deduce_op_from_name(row):
-    name = str(row.get("Tên chỉ tiêu (KPI)") or "")
-    name_l = name.lower()
-    if "≤" in name or "<=" in name_l or "≤ kế hoạch" in name_l: return "<="
-    if "≥" in name or ">=" in name_l: return ">="
-    return "<="
-def _score_penalty_err(row, rule, overrides):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    thr  = overrides.get("thr",  rule.get("thr",1.5))
-    step = overrides.get("step", rule.get("step",0.1))
-    pen  = overrides.get("pen",  rule.get("pen",0.04))
-    cap  = overrides.get("cap",  rule.get("cap",3.0))
-    unit = str(row.get("Đơn vị tính") or "").lower()
-    err_pct = None
-    if actual is not None:
-        if actual<=5 or ("%" in unit and actual<=100):
-            err_pct = to_percent(actual)
-        elif plan not in (None,0):
-            err_pct = abs(actual-plan)/abs(plan)*100.0
-    exceed = max(0.0, (err_pct or 0.0)-(thr or 0.0))
-    steps  = int(exceed // (step or 0.1))
-    penalty = min(cap or 3.0, steps*(pen or 0.04))
-    return -round(penalty,2)
-def _score_penalty_flag(row, rule, overrides):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    pen = overrides.get("pen", rule.get("pen",0.25))
-    op  = overrides.get("op",  rule.get("op")) or _deduce_op_from_name(row)
-    if plan is None or actual is None: return None
-    violated = (actual>plan) if op=="<=" else (actual<plan)
-    return -float(pen) if violated else 0.0
-def _score_ratio_up(row):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    w = _coerce_weight(row.get("Trọng số"))
-    if plan in (None,0) or actual is None: return None
-    return round(max(min(actual/plan,2.0),0.0)*10*w,2)
-def _score_ratio_down(row):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    w = _coerce_weight(row.get("Trọng số"))
-    if plan in (None,0) or actual is None: return None
-    ratio = 1.0 if actual<=plan else max(min(plan/actual,2.0),0.0)
-    return round(ratio*10*w,2)
-def _score_pass_fail(row):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    w = _coerce_weight(row.get("Trọng số"))
-    if plan is None or actual is None: return None
-    return round((10.0 if actual>=plan else 0.0)*w,2)
-def _score_range(row, overrides):
-    lo = overrides.get("lo", parse_float(row.get("Ngưỡng dưới")))
-    hi = overrides.get("hi", parse_float(row.get("Ngưỡng trên")))
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    w = _coerce_weight(row.get("Trọng số"))
-    if lo is None or hi is None or actual is None: return None
-    return round((10.0 if (lo<=actual<=hi) else 0.0)*w,2)
-def _score_expr(row, expr):
-    plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
-    actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    w = _coerce_weight(row.get("Trọng số"))
-    lo = parse_float(row.get("Ngưỡng dưới")); hi = parse_float(row.get("Ngưỡng trên"))
-    try:
-        val = _safe_eval_expr(expr, {"PLAN":plan,"ACTUAL":actual,"W":w,"LO":lo,"HI":hi})
-        return None if val is None else float(val)
-    except Exception:
-        return None
+    return match_rule(method_text, kpi_name=kpi_name, rules=load_rules_registry())
 def compute_score_with_method(row):
-    method_text = str(row.get("Phương pháp đo kết quả") or "").strip()
-    rule, overrides = _match_rule(method_text, kpi_name=row.get("Tên chỉ tiêu (KPI)"))
-    if rule:
-        t = rule.get("Type","").upper()
-        if   t=="PENALTY_ERR":  return _score_penalty_err(row, rule, overrides)
-        elif t=="PENALTY_FLAG": return _score_penalty_flag(row, rule, overrides)
-        elif t=="RATIO_UP":     return _score_ratio_up(row)
-        elif t=="RATIO_DOWN":   return _score_ratio_down(row)
-        elif t=="PASS_FAIL":    return _score_pass_fail(row)
-        elif t=="RANGE":        return _score_range(row, overrides)
-        elif t=="EXPR" and rule.get("expr"): return _score_expr(row, rule["expr"])
-    # fallback hợp lý
+    # Giá trị đang gõ trên biểu mẫu (plan_txt/actual_txt) được ưu tiên như trước
     plan   = parse_vn_number(st.session_state.get("plan_txt","")) if "plan_txt" in st.session_state else None
     actual = parse_vn_number(st.session_state.get("actual_txt","")) if "actual_txt" in st.session_state else None
-    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
-    if actual is None: actual = parse_float(row.get("Thực hiện"))
-    weight = parse_float(row.get("Trọng số")) or 0.0
-    if plan in (None,0) or actual is None: return None
-    w = weight/100.0 if (weight and weight>1) else (weight or 0.0)
-    ratio = max(min(actual/plan,2.0),0.0)
-    return round(ratio*10*w,2)
-
-NUMERIC_COLS = ["Kế hoạch","Thực hiện","Trọng số","Ngưỡng dưới","Ngưỡng trên","Điểm KPI"]
-def coerce_numeric_cols(df: pd.DataFrame) -> pd.DataFrame:
-    df = df.copy()
-    for c in NUMERIC_COLS:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce")
-    return df
+    return kpi_core.compute_score_with_method(row, rules=load_rules_registry(), plan=plan, actual=actual)
 
 # ------------------- ĐĂNG NHẬP -------------------
-def find_use_worksheet(sh):
-    try: return sh.worksheet("USE")
-    except Exception:
-        for ws in sh.worksheets():
-            try: headers = [h.strip() for h in ws.row_values(1)]
-            except Exception: continue
-            if (("USE (mã đăng nhập)" in headers) or ("Tài khoản (USE\\username)" in headers)
-                or ("Tài khoản" in headers) or ("Username" in headers) or ("USE" in headers)) \
-               and ("Mật khẩu mặc định" in headers or "Password" in headers or "Mật khẩu" in headers):
-                return ws
+def load_users_df(force: bool = False):
+    df = load_book_frames(force).get("USE")
+    if df is None:
         raise gspread.exceptions.WorksheetNotFound("Không tìm thấy sheet USE.")
-def load_users_df():
-    sh = open_spreadsheet(st.session_state.get("spreadsheet_id",""))
-    ws = find_use_worksheet(sh)
-    return normalize_columns(df_from_ws(ws))
+    return normalize_columns(df.copy())
 def check_credentials(use_name: str, password: str) -> bool:
-    df = load_users_df()
+    # USE được cache cả phiên: sai thì đọc lại sheet 1 lần (tài khoản/mật khẩu có thể vừa đổi)
+    return _match_credentials(load_users_df(), use_name, password) or \
+           _match_credentials(load_users_df(force=True), use_name, password)
+def _match_credentials(df, use_name: str, password: str) -> bool:
     if df.empty: return False
     col_use = next((c for c in df.columns if c.strip().lower() in ["tài khoản (use\\username)","tài khoản","username","use (mã đăng nhập)","use"]), None)
     col_pw  = next((c for c in df.columns if c.strip().lower() in ["mật khẩu mặc định","password mặc định","password","mật khẩu"]), None)
@@ -434,45 +260,6 @@ def save_report_to_drive(excel_bytes, x_ext, x_mime, pdf_bytes=None):
         st.error(f"Lỗi lưu Google Drive: {e}")
         return False, str(e)
 
-# ------------------- EXPORT -------------------
-def df_to_report_bytes(df: pd.DataFrame):
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="KPI")
-        return buf.getvalue(),"xlsx","application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    except Exception:
-        pass
-    try:
-        buf = io.BytesIO()
-        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
-            df.to_excel(writer, index=False, sheet_name="KPI")
-        return buf.getvalue(),"xlsx","application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    except Exception:
-        data = df.to_csv(index=False).encode("utf-8")
-        return data,"csv","text/csv"
-def generate_pdf_from_df(df: pd.DataFrame, title="BÁO CÁO KPI"):
-    try:
-        from reportlab.lib.pagesizes import A4, landscape
-        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-        from reportlab.lib import colors
-        from reportlab.lib.units import cm
-        from reportlab.lib.styles import getSampleStyleSheet
-        buf = io.BytesIO()
-        doc = SimpleDocTemplate(buf, pagesize=landscape(A4), rightMargin=20,leftMargin=20,topMargin=20,bottomMargin=20)
-        styles = getSampleStyleSheet()
-        story = [Paragraph(title, styles["Title"]), Spacer(1, 0.3*cm)]
-        cols = list(df.columns)
-        data = [cols] + df.fillna("").astype(str).values.tolist()
-        t = Table(data, repeatRows=1)
-        t.setStyle(TableStyle([("BACKGROUND",(0,0),(-1,0),colors.lightgrey),
-                               ("GRID",(0,0),(-1,-1),0.25,colors.grey),
-                               ("FONTSIZE",(0,0),(-1,-1),8),("ALIGN",(0,0),(-1,-1),"CENTER")]))
-        story.append(t); doc.build(story)
-        return buf.getvalue()
-    except Exception:
-        return b""
-
 # ------------------- SIDEBAR -------------------
 with st.sidebar:
     st.header("🔒 Đăng nhập")
@@ -492,6 +279,9 @@ with st.sidebar:
         st.subheader("🧩 Kết nối Google Sheets")
         st.text_input("ID/URL Google Sheet", key="spreadsheet_id")
         st.text_input("Tên sheet KPI", key="kpi_sheet_name")
+        st.checkbox("Ghi phân vùng theo đơn vị/kỳ", key="kpi_partitioned",
+                    help="Mỗi 'Tên đơn vị' × Năm-Tháng ghi vào worksheet riêng '<KPI> | đơn vị | kỳ', có kiểm tra phiên bản "
+                         "để nhiều đơn vị ghi song song mà không ghi đè nhau.")
         st.subheader("📁 Lưu Google Drive (mỗi đơn vị dùng ROOT của chính mình)")
         st.text_input("ID/URL thư mục gốc (của đơn vị)", key="drive_root_id",
                       help="Dán URL thư mục hoặc ID. Service account phải có quyền Editor/Content manager.")
@@ -541,21 +331,28 @@ if "_user" not in st.session_state:
     st.info("Vui lòng đăng nhập để làm việc."); st.stop()
 
 # ------------------- STATE & CỘT KPI -------------------
-KPI_COLS = ["Tên chỉ tiêu (KPI)","Đơn vị tính","Kế hoạch","Thực hiện","Trọng số","Bộ phận/người phụ trách",
-            "Tháng","Năm","Phương pháp đo kết quả","Ngưỡng dưới","Ngưỡng trên","Điểm KPI","Ghi chú","Tên đơn vị"]
-
 def get_sheet_and_name():
     sid_cfg = st.session_state.get("spreadsheet_id","") or GOOGLE_SHEET_ID_DEFAULT
     sheet_name = st.session_state.get("kpi_sheet_name") or KPI_SHEET_DEFAULT
     sh = open_spreadsheet(sid_cfg)
     return sh, sheet_name
 
-def write_kpi_to_sheet(sh, sheet_name, df):
+def _prepare_kpi_df(df):
     df = normalize_columns(df.copy()); df = coerce_numeric_cols(df)
     if "Điểm KPI" not in df.columns:
         df["Điểm KPI"] = df.apply(compute_score_with_method, axis=1)
-    cols = [c for c in KPI_COLS if c in df.columns] + [c for c in df.columns if c not in KPI_COLS]
-    data = [cols] + df[cols].fillna("").astype(str).values.tolist()
+    return df
+
+def _kpi_sheet_cols(df):
+    return [c for c in KPI_COLS if c in df.columns] + [c for c in df.columns if c not in KPI_COLS]
+
+def _kpi_sheet_values(df):
+    cols = _kpi_sheet_cols(df)
+    return [cols] + df[cols].fillna("").astype(str).values.tolist()
+
+def write_kpi_to_sheet(sh, sheet_name, df):
+    data = _kpi_sheet_values(_prepare_kpi_df(df))
+    cols = data[0]
     try:
         try:
             ws = sh.worksheet(sheet_name); ws.clear()
@@ -565,6 +362,239 @@ def write_kpi_to_sheet(sh, sheet_name, df):
     except Exception as e:
         st.error(f"Lưu KPI thất bại: {e}"); return False
 
+# ------------------- GHI PHÂN VÙNG (mỗi đơn vị/kỳ 1 worksheet + phiên bản lạc quan) -------------------
+REV_COLS = ["Phân vùng","Phiên bản","Số dòng","Số cột","Cập nhật lúc","Người ghi","Mã ghi"]
+
+def kpi_partition_title(sheet_name, unit, year, month) -> str:
+    period = f"{_grid_key(year) or '----'}-{(_grid_key(month) or '--').zfill(2)}"
+    title = f"{kpi_partition_prefix(sheet_name)}{_grid_key(unit) or 'Chung'} | {period}"
+    return re.sub(r"[\[\]\*\?:/\\]", "-", title)[:100]
+
+def kpi_partition_keys(df: pd.DataFrame, sheet_name: str) -> pd.Series:
+    empty = pd.Series("", index=df.index)
+    return pd.Series([kpi_partition_title(sheet_name, u, y, m) for u, y, m in
+                      zip(df.get("Tên đơn vị", empty), df.get("Năm", empty), df.get("Tháng", empty))], index=df.index)
+
+def split_kpi_partitions(df: pd.DataFrame, sheet_name: str) -> dict:
+    return {t: g for t, g in df.groupby(kpi_partition_keys(df, sheet_name), sort=False)}
+
+def _rev_map(df) -> dict:
+    # {phân vùng: (số hàng trong sheet REV, phiên bản, số dòng, số cột, mã ghi)}; trùng tên → hàng sau cùng thắng
+    out = {}
+    if df is None or df.empty or "Phân vùng" not in df.columns: return out
+    for i, r in enumerate(df.to_dict("records"), start=2):
+        t = str(r.get("Phân vùng") or "").strip()
+        if t: out[t] = (i, _to_int(r.get("Phiên bản")), _to_int(r.get("Số dòng")), _to_int(r.get("Số cột")),
+                        str(r.get("Mã ghi") or "").strip())
+    return out
+
+def _read_rev_map(sh, rev_title) -> dict:
+    res = sh.values_batch_get([_a1_sheet(rev_title)])
+    return _rev_map(df_from_values(res.get("valueRanges", [{}])[0].get("values", [])))
+
+def _to_int(x):
+    v = parse_float(x)
+    return 0 if v is None or math.isnan(v) else int(v)
+
+def _kpi_tokens_seen(sh, sheet_name) -> dict:
+    # Mã ghi mà phiên này đã thấy cho từng phân vùng (lúc nạp sổ hoặc lần ghi/tải gần nhất) – mốc kiểm tra xung đột
+    seen = st.session_state.setdefault("_kpi_rev_seen", {})
+    key = (sh.id, sheet_name)
+    if key not in seen:
+        try:
+            frames = load_book_frames()
+            book = st.session_state.get("_book_cache") or {}
+            rev_df = frames.get("KPI_REV") if book.get("key") == key else None
+        except Exception:
+            rev_df = None
+        seen[key] = {t: v[4] for t, v in _rev_map(rev_df).items()}
+    return seen[key]
+
+def _cell(v):
+    if v is None or (isinstance(v, float) and math.isnan(v)) or (isinstance(v, str) and not v.strip()): return {}
+    if isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, bool):
+        return {"userEnteredValue": {"numberValue": float(v)}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+def _cell_rows(values):
+    return [{"values": [_cell(v) for v in r]} for r in values]
+
+def _partition_requests(props, t, g):
+    # Ghi cả worksheet bằng 1 updateCells phủ toàn sheet: ô ngoài dữ liệu mới bị xóa trong cùng thao tác,
+    # không phụ thuộc số dòng/cột cũ
+    cols = _kpi_sheet_cols(g)
+    values = [cols] + g[cols].astype(object).where(g[cols].notna(), None).values.tolist()
+    width, reqs = len(cols), []
+    if t in props:
+        sid, grid = props[t]["sheetId"], props[t].get("gridProperties", {})
+        if grid.get("rowCount", 0) < len(values):
+            reqs.append({"appendDimension": {"sheetId": sid, "dimension": "ROWS", "length": len(values)-grid.get("rowCount", 0)+10}})
+        if grid.get("columnCount", 0) < width:
+            reqs.append({"appendDimension": {"sheetId": sid, "dimension": "COLUMNS", "length": width-grid.get("columnCount", 0)}})
+    else:
+        sid = random.randint(1, 2**31-1)
+        reqs.append({"addSheet": {"properties": {"sheetId": sid, "title": t,
+                                                 "gridProperties": {"rowCount": len(values)+10, "columnCount": max(12, width)}}}})
+    reqs.append({"updateCells": {"range": {"sheetId": sid}, "rows": _cell_rows(values), "fields": "userEnteredValue"}})
+    return reqs, len(values)-1, width
+
+def write_kpi_partitions(sh, sheet_name, df, force=False):
+    """Chỉ ghi các phân vùng (đơn vị × kỳ) có trong df, mỗi phân vùng 1 worksheet riêng.
+    Dữ liệu mọi phân vùng + hàng <KPI>_REV (kèm mã ghi) đi trong 1 batchUpdate nguyên khối, nên hàng REV
+    sau cùng luôn khớp dữ liệu đang nằm trên sheet. Mã ghi trong REV khác mốc đã thấy → bỏ qua (trừ khi force).
+    Sau khi ghi đọc lại REV: hàng không còn mang mã của mình nghĩa là người khác đã ghi đè ngay sau đó.
+    Trả về (đã ghi, bỏ qua vì xung đột, đã ghi nhưng bị ghi đè)."""
+    parts = split_kpi_partitions(_prepare_kpi_df(df), sheet_name)
+    rev_title = kpi_rev_sheet(sheet_name)
+    seen = _kpi_tokens_seen(sh, sheet_name)
+    token = f"w-{uuid.uuid4().hex}"
+    ts, user = datetime.now().strftime("%Y-%m-%d %H:%M:%S"), st.session_state.get("_user", "")
+    for attempt in range(3):
+        meta = sh.fetch_sheet_metadata(params={"fields": "sheets.properties(sheetId,title,gridProperties)"})
+        props = {s["properties"]["title"]: s["properties"] for s in meta.get("sheets", [])}
+        current = _read_rev_map(sh, rev_title) if rev_title in props else {}
+        stale = [] if force else [t for t in parts if current.get(t, (0, 0, 0, 0, ""))[4] != seen.get(t, "")]
+        todo = {t: g for t, g in parts.items() if t not in stale}
+        if not todo: return [], stale, []
+
+        reqs, rev_new = [], []
+        if rev_title in props:
+            rev_sid = props[rev_title]["sheetId"]
+        else:
+            rev_sid = random.randint(1, 2**31-1)
+            reqs += [{"addSheet": {"properties": {"sheetId": rev_sid, "title": rev_title,
+                                                  "gridProperties": {"rowCount": 100, "columnCount": len(REV_COLS)}}}},
+                     {"updateCells": {"start": {"sheetId": rev_sid, "rowIndex": 0, "columnIndex": 0},
+                                      "rows": _cell_rows([REV_COLS]), "fields": "userEnteredValue"}}]
+        for t, g in todo.items():
+            part_reqs, nrows, ncols = _partition_requests(props, t, g)
+            reqs += part_reqs
+            row_no, rev = current.get(t, (None, 0))[:2]
+            rev_row = [t, rev+1, nrows, ncols, ts, user, token]
+            if row_no:
+                reqs.append({"updateCells": {"start": {"sheetId": rev_sid, "rowIndex": row_no-1, "columnIndex": 0},
+                                             "rows": _cell_rows([rev_row]), "fields": "userEnteredValue"}})
+            else: rev_new.append(rev_row)
+        if rev_new:
+            reqs.append({"appendCells": {"sheetId": rev_sid, "rows": _cell_rows(rev_new), "fields": "userEnteredValue"}})
+        try:
+            sh.batch_update({"requests": reqs}); break
+        except gspread.exceptions.APIError as e:
+            # Người khác vừa tạo cùng sheet (phân vùng mới hoặc REV): cả lô bị hủy → đọc lại trạng thái và thử lại
+            if "already exists" not in str(e) or attempt == 2: raise
+
+    # Đọc lại REV: ai ghi sau cùng thì mã của người đó nằm trên hàng – người ghi trước biết mình bị ghi đè
+    after = _read_rev_map(sh, rev_title)
+    saved = [t for t in todo if after.get(t, (0, 0, 0, 0, ""))[4] == token]
+    for t in saved: seen[t] = token
+    return saved, stale, [t for t in todo if t not in saved]
+
+def read_kpi_partitions(sh, sheet_name, titles):
+    """Tải nội dung các phân vùng cùng <KPI>_REV trong 1 lần đọc; cập nhật mốc mã ghi đã thấy.
+    Trả về DataFrame gộp các phân vùng còn tồn tại."""
+    rev_title = kpi_rev_sheet(sheet_name)
+    existing = set(sh.sheet_titles(refresh=True))
+    titles = [t for t in titles if t in existing]
+    ranges = [_a1_sheet(t) for t in titles] + ([_a1_sheet(rev_title)] if rev_title in existing else [])
+    grids = [vr.get("values", []) for vr in sh.values_batch_get(ranges).get("valueRanges", [])] if ranges else []
+    rev = _rev_map(df_from_values(grids[len(titles)])) if rev_title in existing else {}
+    seen = _kpi_tokens_seen(sh, sheet_name)
+    for t in titles: seen[t] = rev.get(t, (0, 0, 0, 0, ""))[4]
+    frames = [df_from_values(g) for g in grids[:len(titles)]]
+    return coerce_numeric_cols(normalize_columns(pd.concat(frames, ignore_index=True))) if frames else pd.DataFrame(columns=KPI_COLS)
+
+# ------------------- LƯỚI PHÂN TRANG (lọc/sắp xếp phía server) -------------------
+# Chỉ trang đang xem được gửi xuống st.data_editor; index của _csv_cache là ID dòng ổn định
+GRID_FILTERS = [("Tên đơn vị","Đơn vị"), ("Tháng","Tháng"), ("Bộ phận/người phụ trách","Người phụ trách"),
+                ("_rule_type","Loại quy tắc")]
+GRID_PAGE_SIZES = [20, 50, 100, 200]
+
+def _invalidate_grid():
+    st.session_state["_grid_ver"] = st.session_state.get("_grid_ver", 0) + 1
+
+def _grid_key(v):
+    if v is None or (isinstance(v, float) and math.isnan(v)): return ""
+    if isinstance(v, float) and v.is_integer(): return str(int(v))
+    return str(v).strip()
+
+def _next_row_ids(df, n):
+    start = int(df.index.max())+1 if len(df.index) else 0
+    return list(range(start, start+n))
+
+def ensure_row_ids(df: pd.DataFrame) -> pd.DataFrame:
+    if len(df.index) and (not df.index.is_unique or not pd.api.types.is_integer_dtype(df.index)):
+        df = df.reset_index(drop=True)
+    return df
+
+def rule_type_series(df: pd.DataFrame) -> pd.Series:
+    # _match_rule chỉ chạy 1 lần cho mỗi cặp (phương pháp, tên KPI) khác nhau
+    empty = pd.Series("", index=df.index)
+    meth = df.get("Phương pháp đo kết quả", empty).fillna("").astype(str)
+    name = df.get("Tên chỉ tiêu (KPI)", empty).fillna("").astype(str)
+    memo = {}
+    def _type(pair):
+        if pair not in memo:
+            rule, _ = _match_rule(pair[0].strip(), kpi_name=pair[1])
+            memo[pair] = (str(rule.get("Type","")).upper() if rule else "") or "MẶC ĐỊNH"
+        return memo[pair]
+    return pd.Series([_type(p) for p in zip(meth, name)], index=df.index, dtype=object)
+
+def _sort_key(s: pd.Series) -> pd.Series:
+    # Cột quy đổi được thành số (Tháng, Năm, ...) sắp theo số; còn lại theo chuỗi
+    keys = s.map(_grid_key)
+    num = pd.to_numeric(keys.where(keys != ""), errors="coerce")
+    if num.notna().sum() == (keys != "").sum(): return num
+    return keys.str.lower()
+
+def grid_filter_options(df: pd.DataFrame, col: str):
+    if df.empty: return []
+    if col == "_rule_type": keys = rule_type_series(df)
+    elif col in df.columns: keys = df[col].map(_grid_key)
+    else: return []
+    opts = pd.Series([k for k in keys.unique() if k != ""], dtype=object)
+    return opts.iloc[_sort_key(opts).argsort(kind="mergesort")].tolist()
+
+def filter_sort_view(df: pd.DataFrame, filters: dict, sort_col=None, ascending=True) -> pd.DataFrame:
+    view = df
+    for col, vals in filters.items():
+        if not vals or view.empty: continue
+        if col == "_rule_type": keys = rule_type_series(view)
+        elif col in view.columns: keys = view[col].map(_grid_key)
+        else: continue
+        view = view[keys.isin(list(vals))]
+    if sort_col and sort_col in view.columns and not view.empty:
+        key = (lambda s: pd.to_numeric(s, errors="coerce")) if sort_col in NUMERIC_COLS else _sort_key
+        view = view.sort_values(sort_col, ascending=ascending, kind="mergesort", na_position="last", key=key)
+    return view
+
+def page_slice(view: pd.DataFrame, page: int, page_size: int):
+    n_pages = max(1, math.ceil(len(view)/page_size))
+    page = min(max(1, int(page or 1)), n_pages)
+    start = (page-1)*page_size
+    return view.iloc[start:start+page_size], n_pages, page
+
+def merge_page_edits(base: pd.DataFrame, page_src: pd.DataFrame, page_edit: pd.DataFrame):
+    """Ghép sửa/xóa/thêm trên 1 trang về bảng gốc theo ID dòng. Trả về (bảng mới, có dòng thêm mới)."""
+    edit = page_edit.drop(columns=["✓ Chọn"], errors="ignore")
+    src  = page_src.drop(columns=["✓ Chọn"], errors="ignore")
+    known = edit.index.isin(src.index)
+    kept, added = edit[known], edit[~known]
+    added = added.dropna(how="all")
+    deleted = src.index.difference(kept.index).intersection(base.index)
+    cols = [c for c in kept.columns if c in base.columns]
+    ids = kept.index.intersection(base.index)
+    changed = len(ids) and not kept.loc[ids, cols].equals(src.loc[ids, cols])
+    if not changed and not len(deleted) and added.empty:
+        return base, False
+    out = base.drop(index=deleted)
+    if changed:
+        out = out.astype({c: object for c in cols if c not in NUMERIC_COLS})
+        out.loc[ids, cols] = kept.loc[ids, cols]
+    if not added.empty:
+        added = added.copy(); added.index = _next_row_ids(base, len(added))
+        out = pd.concat([out, added])
+    return coerce_numeric_cols(out), not added.empty
+
 if "_csv_form" not in st.session_state:
     st.session_state["_csv_form"] = {
         "Tên chỉ tiêu (KPI)":"", "Đơn vị tính":"", "Kế hoạch":0.0, "Thực hiện":0.0, "Trọng số":100.0,
@@ -661,40 +691,138 @@ if up is not None:
             tmp["Điểm KPI"] = tmp.apply(compute_score_with_method, axis=1)
         st.session_state["_csv_cache"] = tmp
         st.session_state["_csv_loaded_sig"] = sig
+        _invalidate_grid()
+
+base = ensure_row_ids(st.session_state["_csv_cache"])
+
+# Lọc / sắp xếp / phân trang trên server – chỉ trang hiện tại được gửi xuống trình duyệt
+with st.expander("🔎 Lọc, sắp xếp & phân trang", expanded=False):
+    fc = st.columns(len(GRID_FILTERS))
+    filters = {}
+    for (col, label), holder in zip(GRID_FILTERS, fc):
+        opts = grid_filter_options(base, col); key = f"grid_f_{col}"
+        st.session_state[key] = [v for v in st.session_state.get(key, []) if v in opts]
+        with holder: filters[col] = st.multiselect(label, options=opts, key=key)
+    sc = st.columns([2,1,1,1])
+    sort_opts = ["(giữ nguyên)"] + [c for c in base.columns]
+    if st.session_state.get("grid_sort") not in sort_opts: st.session_state["grid_sort"] = sort_opts[0]
+    with sc[0]: sort_col = st.selectbox("Sắp xếp theo", options=sort_opts, key="grid_sort")
+    with sc[1]: ascending = st.radio("Thứ tự", ["Tăng","Giảm"], horizontal=True, key="grid_asc") == "Tăng"
+    with sc[2]: page_size = st.selectbox("Số dòng/trang", options=GRID_PAGE_SIZES, index=1, key="grid_page_size")
+    view = filter_sort_view(base, filters, None if sort_col == sort_opts[0] else sort_col, ascending)
+    n_pages = max(1, math.ceil(len(view)/page_size))
+    st.session_state["grid_page"] = min(max(1, int(st.session_state.get("grid_page", 1))), n_pages)
+    with sc[3]: page = st.number_input(f"Trang (/{n_pages})", min_value=1, max_value=n_pages, step=1, key="grid_page")
+
+page_df, n_pages, page = page_slice(view, page, page_size)
+view_sig = (st.session_state.get("_grid_ver", 0), tuple((k, tuple(v)) for k, v in filters.items()),
+            sort_col, ascending, page, page_size)
+# Giữ nguyên dữ liệu nguồn của trang khi view không đổi để delta của data_editor áp đúng dòng
+if st.session_state.get("_grid_view_sig") != view_sig:
+    page_src = page_df.copy()
+    if "✓ Chọn" not in page_src.columns:
+        page_src.insert(0,"✓ Chọn",False)
+    page_src["✓ Chọn"] = page_src["✓ Chọn"].astype("bool")
+    sel = st.session_state.get("_selected_idx", None)
+    if sel is not None and sel in page_src.index:
+        page_src.loc[sel,"✓ Chọn"] = True
+    st.session_state["_grid_view_sig"] = view_sig
+    st.session_state["_grid_page_src"] = page_src
+    st.session_state["_grid_view_no"] = st.session_state.get("_grid_view_no", 0) + 1
+page_src = st.session_state["_grid_page_src"]
 
-base = st.session_state["_csv_cache"]
-df_show = base.copy()
-if "✓ Chọn" not in df_show.columns:
-    df_show.insert(0,"✓ Chọn",False)
-df_show["✓ Chọn"] = df_show["✓ Chọn"].astype("bool")
-sel = st.session_state.get("_selected_idx", None)
-if sel is not None and sel in df_show.index:
-    df_show.loc[sel,"✓ Chọn"] = True
+if len(view):
+    first = (page-1)*page_size
+    st.caption(f"Hiển thị {first+1}–{first+len(page_df)} / {len(view)} dòng (tổng {len(base)}).")
 
 df_edit = st.data_editor(
-    df_show, use_container_width=True, hide_index=True, num_rows="dynamic",
+    page_src, use_container_width=True, hide_index=True, num_rows="dynamic",
     column_config={"✓ Chọn": st.column_config.CheckboxColumn(label="✓ Chọn", default=False,
                                                              help="Chọn 1 dòng để nạp lên biểu mẫu")},
-    key="csv_editor",
+    key=f"csv_editor_{st.session_state['_grid_view_no']}",
 )
 
-df_cache = df_edit.drop(columns=["✓ Chọn"], errors="ignore").copy()
-df_cache = coerce_numeric_cols(df_cache)
+df_cache, has_added = merge_page_edits(base, page_src, df_edit)
 st.session_state["_csv_cache"] = df_cache
-
-new_selected_idxs = df_edit.index[df_edit["✓ Chọn"]==True].tolist()
-new_sel = new_selected_idxs[0] if new_selected_idxs else None
-if new_sel != st.session_state.get("_selected_idx"):
+if has_added:
+    _invalidate_grid(); st.rerun()
+
+prev_sel = st.session_state.get("_selected_idx")
+checked = df_edit.index[df_edit["✓ Chọn"]==True].tolist()
+fresh = [i for i in checked if i != prev_sel]
+if fresh: new_sel = fresh[0]
+elif prev_sel in checked or prev_sel not in page_src.index: new_sel = prev_sel
+else: new_sel = None
+if new_sel is not None and new_sel not in df_cache.index: new_sel = None
+if new_sel != prev_sel:
     st.session_state["_selected_idx"] = new_sel
     if new_sel is not None:
         st.session_state["_csv_form"].update({k: df_cache.loc[new_sel].get(k, "") for k in KPI_COLS})
         st.session_state["plan_txt"]   = format_vn_number(parse_float(df_cache.loc[new_sel].get("Kế hoạch")  or 0), 2)
         st.session_state["actual_txt"] = format_vn_number(parse_float(df_cache.loc[new_sel].get("Thực hiện") or 0), 2)
-    st.rerun()
+    _invalidate_grid(); st.rerun()
+
+# ------------------- MÔ PHỎNG WHAT-IF -------------------
+SIM_PCT_RANGE = (-50, 50)
+
+# Chỉ tính & gửi xuống trình duyệt khi người dùng bật (expander vẫn chạy thân khi đang đóng)
+if st.checkbox("🔮 Mô phỏng what-if (Thực hiện thay đổi bao nhiêu thì điểm ra sao?)", key="sim_on"):
+    if df_cache.empty:
+        st.info("Chưa có dữ liệu KPI để mô phỏng.")
+    else:
+        names = sorted(df_cache.get("Tên chỉ tiêu (KPI)", pd.Series(dtype=str)).dropna().astype(str).unique())
+        st.session_state["sim_kpis"] = [v for v in st.session_state.get("sim_kpis", []) if v in names]
+        chosen = st.multiselect("Chỉ tiêu thay đổi (để trống = tất cả)", options=names, key="sim_kpis")
+        sim_cols = [c for c in ["Tên chỉ tiêu (KPI)","Đơn vị tính","Kế hoạch","Thực hiện","Trọng số",
+                                "Phương pháp đo kết quả","Ngưỡng dưới","Ngưỡng trên"] if c in df_cache.columns]
+        # Lưới điểm (mọi dòng × mọi mức %) tính 1 lần bằng numpy, thanh trượt chỉ tra cột
+        sim_sig = (int(pd.util.hash_pandas_object(df_cache[sim_cols].astype(str), index=True).sum()), tuple(chosen))
+        if st.session_state.get("_sim_sig") != sim_sig:
+            params = kpi_core.rule_params(df_cache, load_rules_registry())
+            pcts = np.arange(SIM_PCT_RANGE[0], SIM_PCT_RANGE[1]+1)
+            vary = df_cache["Tên chỉ tiêu (KPI)"].astype(str).isin(chosen).to_numpy() if chosen else np.ones(len(df_cache), bool)
+            factors = np.where(vary[:, None], 1.0 + pcts[None, :]/100.0, 1.0)
+            scores = kpi_core.simulate_scores(df_cache, params["actual"].to_numpy()[:, None]*factors, params=params)
+            st.session_state["_sim_sig"] = sim_sig
+            st.session_state["_sim_grid"] = (params, vary, pd.Series(np.nansum(scores, axis=0).round(2), index=pcts), {})
+        params, vary, totals, be_cache = st.session_state["_sim_grid"]
+        pct = st.slider("% thay đổi Thực hiện", min_value=SIM_PCT_RANGE[0], max_value=SIM_PCT_RANGE[1],
+                        value=0, step=1, key="sim_pct")
+        m = st.columns(2)
+        m[0].metric("Tổng điểm KPI (mô phỏng)", totals[pct], delta=round(totals[pct]-totals[0], 2))
+        m[1].metric("Tổng điểm KPI (Thực hiện hiện tại)", totals[0])
+        st.line_chart(totals.rename("Tổng điểm KPI"), height=180)
+
+        st.markdown("**Điểm hòa vốn – Thực hiện cần đạt cho mỗi KPI**")
+        t = st.columns([2,2,1])
+        with t[0]: tgt_pct = st.slider("Mục tiêu (% điểm tối đa của KPI tính điểm)", 0, 200, 100, 5, key="sim_tgt_pct")
+        with t[1]: max_pen = st.number_input("Điểm trừ tối đa chấp nhận (KPI phạt)", min_value=0.0, value=0.0,
+                                             step=0.01, key="sim_max_pen")
+        # Bảng hòa vốn chỉ gồm các KPI đang chọn, cache cùng lưới điểm theo mục tiêu
+        if (tgt_pct, max_pen) not in be_cache:
+            p_sel = params[vary]
+            target = np.where(p_sel["type"].str.startswith("PENALTY"), -max_pen, tgt_pct/100.0*10*p_sel["w"])
+            be = kpi_core.break_even_actual(df_cache[vary], target, params=p_sel)
+            def _fmt_bound(v):
+                return ("−∞" if v < 0 else "∞") if np.isinf(v) else format_vn_number(v, 2)
+            be["Khoảng đạt"] = ["Không giải ngược (EXPR)" if typ == "EXPR" else
+                                (" ∪ ".join(f"{_fmt_bound(a)} … {_fmt_bound(b)}" for a, b in iv) or "Không đạt được")
+                                for typ, iv in zip(be["Loại quy tắc"], be["Khoảng đạt"])]
+            keep = [c for c in ["Tên chỉ tiêu (KPI)","Tên đơn vị","Kế hoạch","Thực hiện"] if c in df_cache.columns]
+            be_cache.clear()
+            be_cache[(tgt_pct, max_pen)] = pd.concat([df_cache.loc[vary, keep], be,
+                                                      pd.Series(target.round(2), index=be.index, name="Điểm mục tiêu")], axis=1)
+        show = be_cache[(tgt_pct, max_pen)]
+        be_pages = max(1, math.ceil(len(show)/GRID_PAGE_SIZES[1]))
+        st.session_state["sim_be_page"] = min(max(1, int(st.session_state.get("sim_be_page", 1))), be_pages)
+        with t[2]: be_page = st.number_input(f"Trang (/{be_pages})", min_value=1, max_value=be_pages, step=1, key="sim_be_page")
+        show_page, _, _ = page_slice(show, be_page, GRID_PAGE_SIZES[1])
+        st.dataframe(show_page, use_container_width=True, hide_index=True)
+        st.caption("∞ = không giới hạn phía đó; nhiều khoảng nối bằng ∪. Quy tắc EXPR không giải ngược được.")
 
 # --- Apply form vào cache (dùng chung cho các nút) ---
 def apply_form_to_cache():
-    base = st.session_state["_csv_cache"].copy()
+    base = ensure_row_ids(st.session_state["_csv_cache"].copy())
     base = coerce_numeric_cols(base)
     new_row = {c: st.session_state["_csv_form"].get(c,"") for c in KPI_COLS}
     new_row["Kế hoạch"] = parse_vn_number(st.session_state.get("plan_txt",""))
@@ -708,21 +836,63 @@ def apply_form_to_cache():
             else:
                 base.loc[sel,k] = "" if v is None else str(v)
     else:
-        base = pd.concat([base, pd.DataFrame([new_row])], ignore_index=True)
+        base = pd.concat([base, pd.DataFrame([new_row], index=_next_row_ids(base, 1))])
         base = coerce_numeric_cols(base)
     st.session_state["_csv_cache"] = base
+    _invalidate_grid()
 
 # --------- Hành động nút ----------
 if save_csv_clicked:
     try:
         apply_form_to_cache()
         sh, sheet_name = get_sheet_and_name()
-        if write_kpi_to_sheet(sh, sheet_name, st.session_state["_csv_cache"]):
+        if st.session_state.get("kpi_partitioned"):
+            saved, stale, lost = write_kpi_partitions(sh, sheet_name, st.session_state["_csv_cache"])
+            st.session_state["_kpi_conflicts"] = {"stale": stale, "lost": lost}
+            if saved: toast(f"Đã ghi {len(saved)} phân vùng của '{sheet_name}'.","✅")
+            if not stale and not lost: st.rerun()
+        elif write_kpi_to_sheet(sh, sheet_name, st.session_state["_csv_cache"]):
             toast(f"Đã ghi vào sheet '{sheet_name}'.","✅")
             st.rerun()
     except Exception as e:
         st.error(f"Lỗi khi ghi Sheets: {e}")
 
+# Xung đột phân vùng: ghi theo kiểu "người ghi sau thắng" – người dùng chọn tải bản trên sheet hoặc ghi đè
+kc = st.session_state.get("_kpi_conflicts") or {}
+if kc.get("stale") or kc.get("lost"):
+    titles = kc.get("stale", []) + kc.get("lost", [])
+    if kc.get("stale"):
+        st.warning("⚠️ Chưa ghi – phân vùng đã được người khác ghi sau lần bạn tải: " + ", ".join(kc["stale"]))
+    if kc.get("lost"):
+        st.error("⚠️ Đã ghi nhưng người khác ghi đè ngay sau đó, dữ liệu trên sheet hiện là bản của họ: "
+                 + ", ".join(kc["lost"]))
+    c = st.columns(3)
+    if c[0].button("📥 Tải bản trên sheet (thay dữ liệu của bạn ở các phân vùng này)"):
+        try:
+            sh, sheet_name = get_sheet_and_name()
+            remote = read_kpi_partitions(sh, sheet_name, titles)
+            base = ensure_row_ids(st.session_state["_csv_cache"])
+            base = base[~kpi_partition_keys(base, sheet_name).isin(titles)]
+            if not remote.empty: remote.index = _next_row_ids(base, len(remote))
+            st.session_state["_csv_cache"] = coerce_numeric_cols(pd.concat([base, remote]))
+            st.session_state["_selected_idx"] = None
+            st.session_state["_kpi_conflicts"] = {}
+            _invalidate_grid(); toast(f"Đã tải {len(titles)} phân vùng từ sheet.","📥"); st.rerun()
+        except Exception as e:
+            st.error(f"Lỗi khi tải phân vùng: {e}")
+    if c[1].button("⚠️ Ghi đè bằng bản của tôi"):
+        try:
+            sh, sheet_name = get_sheet_and_name()
+            df = st.session_state["_csv_cache"]
+            saved, _, lost = write_kpi_partitions(sh, sheet_name, df[kpi_partition_keys(df, sheet_name).isin(titles)], force=True)
+            st.session_state["_kpi_conflicts"] = {"stale": [], "lost": lost}
+            if saved: toast(f"Đã ghi đè {len(saved)} phân vùng.","✅")
+            if not lost: st.rerun()
+        except Exception as e:
+            st.error(f"Lỗi khi ghi Sheets: {e}")
+    if c[2].button("Bỏ qua"):
+        st.session_state["_kpi_conflicts"] = {}; st.rerun()
+
 if refresh_clicked:
     if "confirm_refresh" not in st.session_state:
         st.session_state["confirm_refresh"] = True
@@ -736,6 +906,7 @@ if st.session_state.get("confirm_refresh", False):
             st.session_state["_csv_cache"] = pd.DataFrame(columns=KPI_COLS)
             st.session_state["_selected_idx"] = None
             st.session_state["confirm_refresh"] = False
+            _invalidate_grid()
             toast("Đã làm mới CSV tạm.","✅"); st.rerun()
         if c[1].button("Không, giữ nguyên"):
             st.session_state["confirm_refresh"] = False; toast("Đã hủy làm mới.","ℹ️")
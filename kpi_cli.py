@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+KPI CLI – chấm điểm & xuất báo cáo hàng loạt, không cần Streamlit
+- Đọc nhiều file/thư mục CSV đơn vị, chạy song song bằng process pool
+- RULES lấy từ file cục bộ (CSV/Excel) hoặc sheet RULES (service account)
+- Ghi CSV/Parquet/Excel/PDF đã chấm điểm + in tóm tắt thông lượng
+
+Ví dụ:
+    python kpi_cli.py data/2025-06 -o out/2025-06 --rules RULES.csv --formats csv,xlsx,pdf -j 8
+"""
+
+import argparse, io, os, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+import pandas as pd
+
+from kpi_core import (RULES_DEFAULT, normalize_columns, coerce_numeric_cols, rules_from_frame,
+                      compute_score_with_method, df_to_report_bytes, generate_pdf_from_df)
+
+FORMATS = ("csv", "parquet", "xlsx", "pdf")
+
+def load_rules(rules_file=None, rules_sheet=None, service_account=None):
+    if rules_file:
+        p = Path(rules_file)
+        if p.suffix.lower() in (".xlsx", ".xls"):
+            df = pd.read_excel(p, sheet_name="RULES") if "RULES" in pd.ExcelFile(p).sheet_names else pd.read_excel(p)
+        else:
+            df = read_csv_any(p.read_bytes())
+        rules = rules_from_frame(df)
+        if not rules: raise SystemExit(f"Không đọc được rule hợp lệ từ {p}")
+        return rules
+    if rules_sheet:
+        import gspread
+        gclient = gspread.service_account(filename=service_account) if service_account else gspread.service_account()
+        values = gclient.open_by_key(rules_sheet).worksheet("RULES").get_all_values()
+        rules = rules_from_frame(pd.DataFrame(values[1:], columns=values[0]) if values else None)
+        if rules: return rules
+        print("⚠️ Sheet RULES rỗng – dùng bộ rule mặc định.", file=sys.stderr)
+    return RULES_DEFAULT
+
+def read_csv_any(data: bytes) -> pd.DataFrame:
+    try: return pd.read_csv(io.BytesIO(data))
+    except Exception: return pd.read_csv(io.BytesIO(data), encoding="utf-8-sig")
+
+def collect_inputs(paths, pattern="*.csv", out_dir=None):
+    """Trả về [(file, đường dẫn tương đối so với gốc đầu vào)]; bỏ qua thư mục --out và file *_scored.*"""
+    out = Path(out_dir).resolve() if out_dir else None
+    def skip(f):
+        fr = f.resolve()
+        return f.stem.endswith("_scored") or (out is not None and (fr == out or out in fr.parents))
+    files = []
+    for raw in paths:
+        p = Path(raw)
+        if p.is_dir(): files.extend((f, f.relative_to(p)) for f in sorted(p.rglob(pattern)) if not skip(f))
+        elif p.is_file():
+            if not skip(p): files.append((p, Path(p.name)))
+        else: print(f"⚠️ Bỏ qua (không tồn tại): {p}", file=sys.stderr)
+    return files
+
+def score_frame(df: pd.DataFrame, rules, rescore=False) -> pd.DataFrame:
+    df = normalize_columns(df)
+    if df is None or df.empty: return df
+    df = coerce_numeric_cols(df)
+    if rescore or "Điểm KPI" not in df.columns:
+        df["Điểm KPI"] = [compute_score_with_method(r, rules=rules) for r in df.to_dict("records")]
+    return df
+
+# --- Worker (mỗi tiến trình nhận bộ rule 1 lần qua initializer) ---
+_WORKER_RULES = None
+def _init_worker(rules):
+    global _WORKER_RULES
+    _WORKER_RULES = rules
+
+def process_file(path, rel, out_dir, formats, rescore=False, title="BÁO CÁO KPI"):
+    t0 = time.perf_counter()
+    src, rel = Path(path), Path(rel)
+    df = score_frame(read_csv_any(src.read_bytes()), _WORKER_RULES or RULES_DEFAULT, rescore)
+    # Giữ nguyên cây thư mục đầu vào dưới --out để file trùng tên ở các đơn vị không ghi đè nhau
+    out = Path(out_dir) / rel.parent; out.mkdir(parents=True, exist_ok=True)
+    stem = f"{rel.stem}_scored"
+    written, skipped = [], []
+    for fmt in formats:
+        try:
+            if fmt == "csv":
+                target = out / f"{stem}.csv"
+                df.to_csv(target, index=False, encoding="utf-8-sig")
+            elif fmt == "parquet":
+                target = out / f"{stem}.parquet"
+                df.to_parquet(target, index=False)
+            elif fmt == "xlsx":
+                data, ext, _ = df_to_report_bytes(df)
+                # Thiếu engine Excel thì df_to_report_bytes trả CSV – không ghi đè file .csv ở trên
+                if ext != "xlsx": raise RuntimeError("không có openpyxl/xlsxwriter để ghi Excel")
+                target = out / f"{stem}.xlsx"
+                target.write_bytes(data)
+            elif fmt == "pdf":
+                data = generate_pdf_from_df(df, f"{title} – {rel.with_suffix('')}")
+                if not data: raise RuntimeError("reportlab không tạo được PDF")
+                target = out / f"{stem}.pdf"
+                target.write_bytes(data)
+            written.append(str(target.relative_to(out_dir)))
+        except Exception as e:
+            skipped.append(f"{fmt}: {e}")
+    total = pd.to_numeric(df.get("Điểm KPI", pd.Series(dtype=float)), errors="coerce").fillna(0).sum() if df is not None else 0.0
+    return {"file": str(rel), "rows": 0 if df is None else len(df), "total": round(float(total), 2),
+            "written": written, "skipped": skipped, "seconds": time.perf_counter()-t0}
+
+def run_batch(files, out_dir, formats, rules, workers=None, rescore=False):
+    results, errors = [], []
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(rules,)) as pool:
+        futs = {pool.submit(process_file, str(f), str(rel), out_dir, formats, rescore): f for f, rel in files}
+        for fut in as_completed(futs):
+            f = futs[fut]
+            try:
+                res = fut.result(); results.append(res)
+                note = f" (bỏ qua {'; '.join(res['skipped'])})" if res["skipped"] else ""
+                print(f"✅ {res['file']}: {res['rows']} dòng, tổng điểm {res['total']}{note}")
+            except Exception as e:
+                errors.append((f, e)); print(f"❌ {f}: {e}", file=sys.stderr)
+    return results, errors
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Chấm điểm & xuất báo cáo KPI hàng loạt (không cần Streamlit).")
+    ap.add_argument("inputs", nargs="+", help="File CSV hoặc thư mục chứa CSV của các đơn vị")
+    ap.add_argument("-o", "--out", default="kpi_out", help="Thư mục ghi kết quả (mặc định: kpi_out)")
+    ap.add_argument("--rules", help="File RULES cục bộ (.csv/.xlsx)")
+    ap.add_argument("--rules-sheet", help="ID Google Sheet chứa sheet RULES")
+    ap.add_argument("--service-account", help="File JSON service account để đọc --rules-sheet")
+    ap.add_argument("--formats", default="csv,xlsx", help=f"Định dạng xuất, phân tách bởi dấu phẩy: {','.join(FORMATS)}")
+    ap.add_argument("--pattern", default="*.csv", help="Mẫu tên file khi quét thư mục (mặc định: *.csv)")
+    ap.add_argument("-j", "--workers", type=int, default=None, help="Số tiến trình song song (mặc định: số CPU)")
+    ap.add_argument("--rescore", action="store_true", help="Tính lại 'Điểm KPI' kể cả khi file đã có cột này")
+    args = ap.parse_args(argv)
+
+    formats = [f.strip().lower() for f in args.formats.split(",") if f.strip()]
+    bad = [f for f in formats if f not in FORMATS]
+    if bad: ap.error(f"Định dạng không hỗ trợ: {', '.join(bad)}")
+    files = collect_inputs(args.inputs, args.pattern, args.out)
+    if not files: ap.error("Không tìm thấy file CSV đầu vào.")
+    seen = {}
+    for f, rel in files:
+        key = str(rel.with_suffix("")).lower()
+        if key in seen: ap.error(f"Hai file đầu vào cùng đường dẫn kết quả '{rel}': {seen[key]} và {f}")
+        seen[key] = f
+    rules = load_rules(args.rules, args.rules_sheet, args.service_account)
+
+    t0 = time.perf_counter()
+    results, errors = run_batch(files, args.out, formats, rules, args.workers, args.rescore)
+    elapsed = time.perf_counter() - t0
+    rows = sum(r["rows"] for r in results)
+    print(f"\nTổng kết: {len(results)}/{len(files)} file, {rows} dòng, {elapsed:.2f}s "
+          f"→ {len(results)/elapsed if elapsed else 0:.2f} file/s, {rows/elapsed if elapsed else 0:.0f} dòng/s"
+          f" ({args.workers or os.cpu_count()} tiến trình). Kết quả: {Path(args.out).resolve()}")
+    return 1 if errors else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+KPI core – phần dùng chung không phụ thuộc Streamlit
+- Chuẩn hóa cột, số kiểu VN
+- Rule engine chấm điểm KPI + mô phỏng what-if vectơ hóa
+- Xuất báo cáo Excel/PDF
+Dùng bởi app.py (giao diện) và kpi_cli.py (chạy nền/batch).
+"""
+
+import re, io, math, ast
+import numpy as np
+import pandas as pd
+
+KPI_COLS = ["Tên chỉ tiêu (KPI)","Đơn vị tính","Kế hoạch","Thực hiện","Trọng số","Bộ phận/người phụ trách",
+            "Tháng","Năm","Phương pháp đo kết quả","Ngưỡng dưới","Ngưỡng trên","Điểm KPI","Ghi chú","Tên đơn vị"]
+
+ALIAS = {
+    "USE (mã đăng nhập)": ["USE (mã đăng nhập)", r"Tài khoản (USE\\username)", "Tài khoản (USE/username)", "Tài khoản", "Username", "USE", "User"],
+    "Mật khẩu mặc định": ["Mật khẩu mặc định", "Password mặc định", "Password", "Mật khẩu"],
+    "Tên chỉ tiêu (KPI)": ["Tên chỉ tiêu (KPI)", "Tên KPI", "Chỉ tiêu"],
+    "Đơn vị tính": ["Đơn vị tính", "Unit"],
+    "Kế hoạch": ["Kế hoạch", "Plan", "Target", "Kế hoạch (tháng)"],
+    "Thực hiện": ["Thực hiện", "Thực hiện (tháng)", "Actual (month)"],
+    "Trọng số": ["Trọng số", "Weight"],
+    "Bộ phận/người phụ trách": ["Bộ phận/người phụ trách", "Phụ trách"],
+    "Tháng": ["Tháng", "Month"],
+    "Năm": ["Năm", "Year"],
+    "Điểm KPI": ["Điểm KPI", "Score"],
+    "Ghi chú": ["Ghi chú", "Notes"],
+    "Tên đơn vị": ["Tên đơn vị", "Đơn vị"],
+    "Phương pháp đo kết quả": ["Phương pháp đo kết quả", "Cách tính", "Công thức"],
+    "Ngưỡng dưới": ["Ngưỡng dưới", "Min"],
+    "Ngưỡng trên": ["Ngưỡng trên", "Max"],
+}
+def normalize_columns(df: pd.DataFrame) -> pd.DataFrame:
+    if df is None or df.empty: return df
+    cols_lower = {c.strip().lower(): c for c in df.columns}
+    rename = {}
+    for std, cands in ALIAS.items():
+        if std in df.columns: continue
+        for c in cands:
+            key = c.strip().lower()
+            if key in cols_lower:
+                rename[cols_lower[key]] = std
+                break
+    if rename: df = df.rename(columns=rename)
+    if "Thực hiện (tháng)" in df.columns and "Thực hiện" not in df.columns:
+        df = df.rename(columns={"Thực hiện (tháng)":"Thực hiện"})
+    if "Kế hoạch (tháng)" in df.columns and "Kế hoạch" not in df.columns:
+        df = df.rename(columns={"Kế hoạch (tháng)":"Kế hoạch"})
+    return df
+
+def format_vn_number(x, decimals=2):
+    try: f = float(x)
+    except Exception: return ""
+    s = f"{f:,.{decimals}f}"
+    return s.replace(",", "_").replace(".", ",").replace("_", ".")
+
+def parse_vn_number(s):
+    if s is None: return None
+    txt = str(s).strip()
+    if txt == "" or txt.lower() in ("none", "nan"): return None
+    txt = txt.replace(".", "").replace(",", ".")
+    try: return float(txt)
+    except Exception: return None
+
+def parse_float(x):
+    if isinstance(x,(int,float)): return float(x)
+    return parse_vn_number(x)
+
+def to_percent(val):
+    v = parse_float(val)
+    if v is None: return None
+    return v*100.0 if abs(v)<=1.0 else v
+
+
+# ===================== RULE ENGINE (tóm lược) =====================
+RULES_DEFAULT = [
+    {"Code":"PENALTY_ERR_004","Type":"PENALTY_ERR","thr":1.5,"step":0.1,"pen":0.04,"cap":3.0,"keywords":"dự báo tổng thương phẩm; sai số ±1,5%; trừ 0,04; tru 0,04"},
+    {"Code":"PENALTY_ERR_002","Type":"PENALTY_ERR","thr":1.5,"step":0.1,"pen":0.02,"cap":3.0,"keywords":"sai số ±1,5%; trừ 0,02; tru 0,02"},
+    {"Code":"PENALTY_FLAG_025","Type":"PENALTY_FLAG","pen":0.25,"keywords":"vượt chỉ tiêu; 0,25; saifi; saidi"},
+    {"Code":"RATIO_UP","Type":"RATIO_UP","keywords":"tăng tốt hơn; >="},
+    {"Code":"RATIO_DOWN","Type":"RATIO_DOWN","keywords":"giảm tốt hơn; <="},
+    {"Code":"PASS_FAIL","Type":"PASS_FAIL","keywords":"đạt/không đạt"},
+    {"Code":"RANGE","Type":"RANGE","keywords":"khoảng; range"},
+]
+def _to_float(x): 
+    try: return float(x)
+    except: return None
+def _coerce_weight(w):
+    w = _to_float(w) or 0.0
+    return w/100.0 if w>1 else max(w,0.0)
+def _safe_eval_expr(expr, env):
+    allowed_names = {"min":min,"max":max,"abs":abs,"round":round,"math":math}
+    allowed_vars  = {k:(v if v is not None else 0.0) for k,v in env.items()}
+    code = ast.parse(expr, mode="eval")
+    for node in ast.walk(code):
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                if node.func.id not in allowed_names: raise ValueError("Func not allowed")
+            elif isinstance(node.func, ast.Attribute):
+                if not (isinstance(node.func.value, ast.Name) and node.func.value.id=="math"):
+                    raise ValueError("Only math.* allowed")
+        elif not isinstance(node,(ast.Expression,ast.BinOp,ast.UnaryOp,ast.Num,ast.Name,ast.Load,
+                                  ast.Add,ast.Sub,ast.Mult,ast.Div,ast.Pow,ast.Mod,ast.FloorDiv,
+                                  ast.USub,ast.UAdd,ast.Call,ast.Attribute,ast.Constant,ast.Compare,
+                                  ast.Gt,ast.Lt,ast.GtE,ast.LtE,ast.Eq,ast.NotEq,ast.BoolOp,ast.And,ast.Or,ast.IfExp)):
+            raise ValueError("Unsafe")
+    return eval(compile(code,"<expr>","eval"),{"__builtins__":{},**allowed_names},allowed_vars)
+def rules_from_frame(df: pd.DataFrame):
+    """Đọc bảng RULES (sheet hoặc file) thành list rule; rỗng nếu không có dòng hợp lệ."""
+    rules = []
+    if df is None or df.empty: return rules
+    for r in df.fillna("").to_dict("records"):
+        rule = {str(k).strip(): v for k,v in r.items()}
+        rule["Code"] = str(rule.get("Code") or "").strip()
+        rule["Type"] = str(rule.get("Type") or "").strip().upper()
+        for k in ("thr","step","pen","cap"):
+            rule[k] = _to_float(rule.get(k)) if (str(rule.get(k) or "")!="") else None
+        for k in ("op","lo","hi"):
+            rule[k] = rule.get(k) if str(rule.get(k) or "")!="" else None
+        rule["expr"] = str(rule.get("expr") or "").strip()
+        rule["keywords"] = str(rule.get("keywords") or "").lower()
+        if rule["Code"] and rule["Type"]:
+            rules.append(rule)
+    return rules
+def _parse_overrides(txt):
+    code, overrides = None, {}
+    m = re.search(r"\[([A-Za-z0-9_]+)\]", str(txt))
+    if m: code = m.group(1).strip().upper()
+    for k,v in re.findall(r"([A-Za-z_]+)\s*=\s*([0-9\.,-]+)", str(txt)):
+        k = k.strip().lower(); v = v.strip().replace(".","").replace(",",".")
+        overrides[k] = _to_float(v) if k!="op" else v
+    mop = re.search(r"op\s*=\s*(<=|>=)", str(txt))
+    if mop: overrides["op"] = mop.group(1)
+    return code, overrides
+def match_rule(method_text, kpi_name=None, rules=None):
+    rules = rules or RULES_DEFAULT
+    txt = (method_text or "").strip()
+    code, overrides = _parse_overrides(txt)
+    if code:
+        for r in rules:
+            if r.get("Code","").upper()==code: return r, overrides
+    t = txt.lower()
+    for r in rules:
+        kw = r.get("keywords","")
+        if any(k.strip() and k.strip() in t for k in kw.split(";")):
+            return r, {}
+    if kpi_name:
+        name = str(kpi_name)
+        if "≤" in name or "<=" in name.lower(): return {"Code":"RATIO_DOWN_AUTO","Type":"RATIO_DOWN"}, {}
+        if "≥" in name or ">=" in name.lower(): return {"Code":"RATIO_UP_AUTO","Type":"RATIO_UP"}, {}
+    return None, {}
+def _deduce_op_from_name(row):
+    name = str(row.get("Tên chỉ tiêu (KPI)") or "")
+    name_l = name.lower()
+    if "≤" in name or "<=" in name_l or "≤ kế hoạch" in name_l: return "<="
+    if "≥" in name or ">=" in name_l: return ">="
+    return "<="
+def _score_penalty_err(row, plan, actual, rule, overrides):
+    thr  = overrides.get("thr",  rule.get("thr",1.5))
+    step = overrides.get("step", rule.get("step",0.1))
+    pen  = overrides.get("pen",  rule.get("pen",0.04))
+    cap  = overrides.get("cap",  rule.get("cap",3.0))
+    unit = str(row.get("Đơn vị tính") or "").lower()
+    err_pct = None
+    if actual is not None:
+        if actual<=5 or ("%" in unit and actual<=100):
+            err_pct = to_percent(actual)
+        elif plan not in (None,0):
+            err_pct = abs(actual-plan)/abs(plan)*100.0
+    exceed = max(0.0, (err_pct or 0.0)-(thr or 0.0))
+    steps  = int(exceed // (step or 0.1))
+    penalty = min(cap or 3.0, steps*(pen or 0.04))
+    return -round(penalty,2)
+def _score_penalty_flag(row, plan, actual, rule, overrides):
+    pen = overrides.get("pen", rule.get("pen",0.25))
+    op  = overrides.get("op",  rule.get("op")) or _deduce_op_from_name(row)
+    if plan is None or actual is None: return None
+    violated = (actual>plan) if op=="<=" else (actual<plan)
+    return -float(pen) if violated else 0.0
+def _score_ratio_up(row, plan, actual):
+    w = _coerce_weight(row.get("Trọng số"))
+    if plan in (None,0) or actual is None: return None
+    return round(max(min(actual/plan,2.0),0.0)*10*w,2)
+def _score_ratio_down(row, plan, actual):
+    w = _coerce_weight(row.get("Trọng số"))
+    if plan in (None,0) or actual is None: return None
+    ratio = 1.0 if actual<=plan else max(min(plan/actual,2.0),0.0)
+    return round(ratio*10*w,2)
+def _score_pass_fail(row, plan, actual):
+    w = _coerce_weight(row.get("Trọng số"))
+    if plan is None or actual is None: return None
+    return round((10.0 if actual>=plan else 0.0)*w,2)
+def _score_range(row, actual, overrides):
+    lo = overrides.get("lo", parse_float(row.get("Ngưỡng dưới")))
+    hi = overrides.get("hi", parse_float(row.get("Ngưỡng trên")))
+    w = _coerce_weight(row.get("Trọng số"))
+    if lo is None or hi is None or actual is None: return None
+    return round((10.0 if (lo<=actual<=hi) else 0.0)*w,2)
+def _score_expr(row, plan, actual, expr):
+    w = _coerce_weight(row.get("Trọng số"))
+    lo = parse_float(row.get("Ngưỡng dưới")); hi = parse_float(row.get("Ngưỡng trên"))
+    try:
+        val = _safe_eval_expr(expr, {"PLAN":plan,"ACTUAL":actual,"W":w,"LO":lo,"HI":hi})
+        return None if val is None else float(val)
+    except Exception:
+        return None
+def compute_score_with_method(row, rules=None, plan=None, actual=None):
+    """Chấm điểm 1 dòng KPI. plan/actual (nếu có) được ưu tiên hơn giá trị trong dòng."""
+    if plan is None:   plan   = parse_float(row.get("Kế hoạch"))
+    if actual is None: actual = parse_float(row.get("Thực hiện"))
+    method_text = str(row.get("Phương pháp đo kết quả") or "").strip()
+    rule, overrides = match_rule(method_text, kpi_name=row.get("Tên chỉ tiêu (KPI)"), rules=rules)
+    if rule:
+        t = rule.get("Type","").upper()
+        if   t=="PENALTY_ERR":  return _score_penalty_err(row, plan, actual, rule, overrides)
+        elif t=="PENALTY_FLAG": return _score_penalty_flag(row, plan, actual, rule, overrides)
+        elif t=="RATIO_UP":     return _score_ratio_up(row, plan, actual)
+        elif t=="RATIO_DOWN":   return _score_ratio_down(row, plan, actual)
+        elif t=="PASS_FAIL":    return _score_pass_fail(row, plan, actual)
+        elif t=="RANGE":        return _score_range(row, actual, overrides)
+        elif t=="EXPR" and rule.get("expr"): return _score_expr(row, plan, actual, rule["expr"])
+    # fallback hợp lý
+    weight = parse_float(row.get("Trọng số")) or 0.0
+    if plan in (None,0) or actual is None: return None
+    w = weight/100.0 if (weight and weight>1) else (weight or 0.0)
+    ratio = max(min(actual/plan,2.0),0.0)
+    return round(ratio*10*w,2)
+
+NUMERIC_COLS = ["Kế hoạch","Thực hiện","Trọng số","Ngưỡng dưới","Ngưỡng trên","Điểm KPI"]
+def coerce_numeric_cols(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for c in NUMERIC_COLS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce")
+    return df
+
+# ===================== WHAT-IF (mô phỏng vectơ hóa) =====================
+def _col_float(df, col):
+    if col not in df.columns: return np.full(len(df), np.nan)
+    return np.array([np.nan if v is None else v for v in df[col].map(parse_float)], dtype=float)
+
+def rule_params(df: pd.DataFrame, rules=None) -> pd.DataFrame:
+    """Tham số quy tắc đã phân giải cho từng dòng (match_rule chạy 1 lần/cặp phương pháp–tên KPI)."""
+    n = len(df)
+    meth = df["Phương pháp đo kết quả"].fillna("").astype(str) if "Phương pháp đo kết quả" in df.columns else pd.Series([""]*n)
+    name = df["Tên chỉ tiêu (KPI)"].fillna("").astype(str) if "Tên chỉ tiêu (KPI)" in df.columns else pd.Series([""]*n)
+    unit = df["Đơn vị tính"].fillna("").astype(str) if "Đơn vị tính" in df.columns else pd.Series([""]*n)
+    lo_row, hi_row = _col_float(df, "Ngưỡng dưới"), _col_float(df, "Ngưỡng trên")
+    memo, recs = {}, []
+    for i, (m, nm, u) in enumerate(zip(meth, name, unit)):
+        key = (m.strip(), nm)
+        if key not in memo: memo[key] = match_rule(key[0], kpi_name=nm or None, rules=rules)
+        rule, ov = memo[key]
+        rule = rule or {}
+        t = str(rule.get("Type","")).upper()
+        if t not in ("PENALTY_ERR","PENALTY_FLAG","RATIO_UP","RATIO_DOWN","PASS_FAIL","RANGE") \
+           and not (t=="EXPR" and rule.get("expr")):
+            t = "MẶC ĐỊNH"
+        lo, hi = ov.get("lo", lo_row[i]), ov.get("hi", hi_row[i])
+        d_pen = 0.25 if t=="PENALTY_FLAG" else 0.04
+        recs.append({
+            "type": t,
+            "thr":  ov.get("thr",  rule.get("thr",1.5)) or 0.0,
+            "step": ov.get("step", rule.get("step",0.1)) or 0.1,
+            "pen":  ov.get("pen",  rule.get("pen",d_pen)) or (0.0 if t=="PENALTY_FLAG" else 0.04),
+            "cap":  ov.get("cap",  rule.get("cap",3.0)) or 3.0,
+            "op":   ov.get("op",   rule.get("op")) or _deduce_op_from_name({"Tên chỉ tiêu (KPI)": nm}),
+            "lo": np.nan if lo is None else float(lo), "hi": np.nan if hi is None else float(hi),
+            "pct_unit": "%" in u.lower(), "expr": rule.get("expr",""),
+        })
+    p = pd.DataFrame(recs, index=df.index,
+                     columns=["type","thr","step","pen","cap","op","lo","hi","pct_unit","expr"])
+    p["plan"], p["actual"] = _col_float(df, "Kế hoạch"), _col_float(df, "Thực hiện")
+    w = np.nan_to_num(_col_float(df, "Trọng số"))
+    p["w"] = np.where(w>1, w/100.0, np.maximum(w, 0.0))
+    return p
+
+def simulate_scores(df: pd.DataFrame, actual_grid, rules=None, params=None) -> np.ndarray:
+    """Chấm điểm mọi dòng trên lưới giá trị Thực hiện giả định (n dòng × k cột) trong 1 lượt numpy.
+    Kết quả khớp compute_score_with_method theo từng ô (lệch làm tròn tối đa 0,01); NaN khi không tính được."""
+    p = rule_params(df, rules) if params is None else params
+    A = np.asarray(actual_grid, dtype=float)
+    if A.ndim == 1: A = A[:, None]
+    col = lambda c: p[c].to_numpy(dtype=float)[:, None]
+    P, W, t = col("plan"), col("w"), p["type"].to_numpy()[:, None]
+    out = np.full(A.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ok = ~np.isnan(A) & ~np.isnan(P)
+        pos = ok & (P != 0)
+        up = np.round(np.clip(A/P, 0.0, 2.0)*10*W, 2)
+        out = np.where(((t=="RATIO_UP") | (t=="MẶC ĐỊNH")) & pos, up, out)
+        down = np.where(A<=P, 1.0, np.clip(P/A, 0.0, 2.0))
+        out = np.where((t=="RATIO_DOWN") & pos, np.round(down*10*W, 2), out)
+        out = np.where((t=="PASS_FAIL") & ok, np.round(np.where(A>=P, 10.0, 0.0)*W, 2), out)
+        LO, HI = col("lo"), col("hi")
+        in_rng = (LO<=A) & (A<=HI)
+        out = np.where((t=="RANGE") & ~np.isnan(A) & ~np.isnan(LO) & ~np.isnan(HI),
+                       np.round(np.where(in_rng, 10.0, 0.0)*W, 2), out)
+        le = (p["op"].to_numpy()=="<=")[:, None]
+        violated = np.where(le, A>P, A<P)
+        out = np.where((t=="PENALTY_FLAG") & ok, np.where(violated, -col("pen"), 0.0), out)
+        # PENALTY_ERR: sai số % lấy trực tiếp (đơn vị %/giá trị nhỏ) hoặc |A-P|/|P|
+        pct_mode = (A<=5) | (p["pct_unit"].to_numpy()[:, None] & (A<=100))
+        err = np.where(pct_mode, np.where(np.abs(A)<=1.0, A*100.0, A),
+                       np.where(pos, np.abs(A-P)/np.abs(P)*100.0, 0.0))
+        err = np.where(np.isnan(A), 0.0, err)
+        steps = np.floor_divide(np.maximum(0.0, err-col("thr")), col("step"))
+        out = np.where(t=="PENALTY_ERR", -np.round(np.minimum(col("cap"), steps*col("pen")), 2), out)
+    for i in np.flatnonzero(p["type"].to_numpy()=="EXPR"):
+        row = df.iloc[i].to_dict()
+        for j in range(A.shape[1]):
+            v = _score_expr(row, None if np.isnan(P[i,0]) else P[i,0], None if np.isnan(A[i,j]) else A[i,j],
+                            p["expr"].iat[i])
+            out[i, j] = np.nan if v is None else v
+    return out
+
+def break_even_actual(df: pd.DataFrame, target, rules=None, params=None) -> pd.DataFrame:
+    """Các khoảng Thực hiện để đạt điểm ≥ target (giải ngược giải tích).
+    RATIO_UP/RATIO_DOWN/PASS_FAIL/RANGE: target là điểm; PENALTY_*: target là điểm trừ (≤ 0).
+    Cột "Khoảng đạt" là list (lo, hi) rời nhau, tăng dần; list rỗng = không thể đạt; ±inf = không giới hạn.
+    Không xét tính đóng/mở ở đầu mút. EXPR không giải ngược."""
+    p = rule_params(df, rules) if params is None else params
+    S = np.broadcast_to(np.asarray(target, dtype=float), (len(p),)).copy()
+    P, W, t = p["plan"].to_numpy(), p["w"].to_numpy(), p["type"].to_numpy()
+    lo, hi = np.full(len(p), np.nan), np.full(len(p), np.nan)
+    inf = np.inf
+    def put(mask, l, h):
+        lo[mask] = np.broadcast_to(l, lo.shape)[mask]; hi[mask] = np.broadcast_to(h, hi.shape)[mask]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = S/(10*W)
+        any_ok = S<=0
+        # RATIO_UP (và mặc định): điểm = clip(A/P,0,2)·10W → A/P ≥ r: A ≥ r·P (P>0), A ≤ r·P (P<0)
+        m = ((t=="RATIO_UP") | (t=="MẶC ĐỊNH")) & (P!=0) & ~np.isnan(P)
+        put(m & any_ok, -inf, inf)
+        solve = m & ~any_ok & (W>0) & (r<=2)
+        put(solve & (P>0), r*P, inf); put(solve & (P<0), -inf, r*P)
+        # RATIO_DOWN: đủ điểm khi A ≤ P, sau đó theo P/A
+        #   P>0: P/A giảm dần → A ≤ P/r (r ≤ 1)
+        #   P<0: P<A<0 cho P/A ∈ (1, 2], A ≥ 0 cho 0 → r ≤ 1: A < 0; 1 < r ≤ 2: P/r ≤ A < 0
+        m = (t=="RATIO_DOWN") & (P!=0) & ~np.isnan(P)
+        put(m & any_ok, -inf, inf)
+        solve = m & ~any_ok & (W>0)
+        put(solve & (P>0) & (r<=1), -inf, P/r)
+        put(solve & (P<0) & (r<=1), -inf, 0.0)
+        put(solve & (P<0) & (r>1) & (r<=2), P/r, 0.0)
+        # PASS_FAIL / RANGE: bậc thang 0 ↔ 10W
+        reach = any_ok | ((W>0) & (S<=10*W))
+        m = (t=="PASS_FAIL") & ~np.isnan(P)
+        put(m & any_ok, -inf, inf); put(m & ~any_ok & reach, P, inf)
+        LO, HI = p["lo"].to_numpy(), p["hi"].to_numpy()
+        m = (t=="RANGE") & ~np.isnan(LO) & ~np.isnan(HI)
+        put(m & any_ok, -inf, inf); put(m & ~any_ok & reach, LO, HI)
+        # PENALTY_FLAG: chấp nhận -pen thì mọi giá trị, ngược lại không được vi phạm
+        pen = p["pen"].to_numpy()
+        m = (t=="PENALTY_FLAG") & ~np.isnan(P)
+        le = p["op"].to_numpy()=="<="
+        put(m & (S<=-pen), -inf, inf)
+        put(m & (S>-pen) & (S<=0) & le, -inf, P)
+        put(m & (S>-pen) & (S<=0) & ~le, P, inf)
+        # PENALTY_ERR: điểm trừ = min(cap, ⌊(sai số−thr)/step⌋·pen) → đạt khi sai số < E = thr + (k+1)·step
+        thr, step, cap = p["thr"].to_numpy(), p["step"].to_numpy(), p["cap"].to_numpy()
+        allowed = -S
+        k = np.floor(allowed/pen + 1e-9)
+        E = thr + (k+1)*step
+    ranges = [[] if np.isnan(a) else [(a, b)] for a, b in zip(lo, hi)]
+    pct_unit = p["pct_unit"].to_numpy()
+    for i in np.flatnonzero(t=="PENALTY_ERR"):
+        if S[i] > 0: continue
+        if allowed[i] >= cap[i]: ranges[i] = [(-inf, inf)]; continue
+        ranges[i] = _penalty_err_ranges(E[i], P[i], pct_unit[i])
+    return pd.DataFrame({"Loại quy tắc": t, "Khoảng đạt": ranges}, index=p.index)
+
+def _penalty_err_ranges(E, P, pct_unit):
+    # Giải theo đúng các vùng của _score_penalty_err:
+    #   A ≤ U (U=100 nếu đơn vị %, ngược lại 5): sai số = A·100 khi |A| ≤ 1, = A khi ngoài [-1, 1]
+    #   A > U: sai số = |A−P|/|P|·100 (P trống/0 → sai số 0)
+    U = 100.0 if pct_unit else 5.0
+    iv = [(-np.inf, min(1.0, E/100.0))]          # A < -1 luôn đạt; -1 ≤ A ≤ 1 cần A < E/100
+    if E > 1.0: iv.append((1.0, min(U, E)))      # 1 < A ≤ U cần A < E
+    if np.isnan(P) or P == 0:
+        iv.append((U, np.inf))
+    else:
+        d = abs(P)*E/100.0
+        if P+d > U: iv.append((max(U, P-d), P+d))
+    out = []
+    for a, b in sorted(iv):
+        if out and a <= out[-1][1]: out[-1] = (out[-1][0], max(out[-1][1], b))
+        else: out.append((a, b))
+    return out
+
+# ------------------- EXPORT -------------------
+def df_to_report_bytes(df: pd.DataFrame):
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="openpyxl") as writer:
+            df.to_excel(writer, index=False, sheet_name="KPI")
+        return buf.getvalue(),"xlsx","application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    except Exception:
+        pass
+    try:
+        buf = io.BytesIO()
+        with pd.ExcelWriter(buf, engine="xlsxwriter") as writer:
+            df.to_excel(writer, index=False, sheet_name="KPI")
+        return buf.getvalue(),"xlsx","application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    except Exception:
+        data = df.to_csv(index=False).encode("utf-8")
+        return data,"csv","text/csv"
+def generate_pdf_from_df(df: pd.DataFrame, title="BÁO CÁO KPI"):
+    try:
+        from reportlab.lib.pagesizes import A4, landscape
+        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+        from reportlab.lib import colors
+        from reportlab.lib.units import cm
+        from reportlab.lib.styles import getSampleStyleSheet
+        buf = io.BytesIO()
+        doc = SimpleDocTemplate(buf, pagesize=landscape(A4), rightMargin=20,leftMargin=20,topMargin=20,bottomMargin=20)
+        styles = getSampleStyleSheet()
+        story = [Paragraph(title, styles["Title"]), Spacer(1, 0.3*cm)]
+        cols = list(df.columns)
+        data = [cols] + df.fillna("").astype(str).values.tolist()
+        t = Table(data, repeatRows=1)
+        t.setStyle(TableStyle([("BACKGROUND",(0,0),(-1,0),colors.lightgrey),
+                               ("GRID",(0,0),(-1,-1),0.25,colors.grey),
+                               ("FONTSIZE",(0,0),(-1,-1),8),("ALIGN",(0,0),(-1,-1),"CENTER")]))
+        story.append(t); doc.build(story)
+        return buf.getvalue()
+    except Exception:
+        return b""
+
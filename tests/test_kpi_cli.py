@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""CLI chấm điểm hàng loạt: quét đầu vào và đường dẫn kết quả phản chiếu cây thư mục."""
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import kpi_cli as cli
+import kpi_core as k
+
+ROW = {"Tên chỉ tiêu (KPI)": "KPI", "Đơn vị tính": "kWh", "Kế hoạch": 100, "Thực hiện": 90,
+       "Trọng số": 10, "Phương pháp đo kết quả": "Tăng tốt hơn"}
+
+def _tree(tmp_path):
+    root = tmp_path / "in"
+    for rel in ("DHA/2025-06.csv", "PLU/2025-06.csv", "PLU/2025-06_scored.csv", "out/DHA/2025-06_scored.csv"):
+        f = root / rel; f.parent.mkdir(parents=True, exist_ok=True)
+        pd.DataFrame([ROW]).to_csv(f, index=False)
+    return root
+
+def test_collect_inputs_skips_out_dir_and_scored(tmp_path):
+    root = _tree(tmp_path)
+    files = cli.collect_inputs([root], out_dir=root / "out")
+    assert [str(rel) for _, rel in files] == [str(Path("DHA/2025-06.csv")), str(Path("PLU/2025-06.csv"))]
+    single = cli.collect_inputs([root / "PLU" / "2025-06_scored.csv"])
+    assert single == []
+
+def test_process_file_mirrors_input_tree(tmp_path):
+    root = _tree(tmp_path); out = tmp_path / "out"
+    cli._init_worker(k.RULES_DEFAULT)
+    for f, rel in cli.collect_inputs([root], out_dir=out):
+        res = cli.process_file(f, rel, out, ["csv"])
+        assert res["written"] == [str(rel.parent / "2025-06_scored.csv")] and not res["skipped"]
+    assert (out / "DHA" / "2025-06_scored.csv").is_file() and (out / "PLU" / "2025-06_scored.csv").is_file()
+    scored = pd.read_csv(out / "DHA" / "2025-06_scored.csv", encoding="utf-8-sig")
+    assert scored["Điểm KPI"].iloc[0] == k.compute_score_with_method(ROW)
+
+def test_xlsx_fallback_is_skipped_not_written(tmp_path, monkeypatch):
+    root = _tree(tmp_path); out = tmp_path / "out"
+    monkeypatch.setattr(cli, "df_to_report_bytes", lambda df: (b"x", "csv", "text/csv"))
+    res = cli.process_file(root / "DHA" / "2025-06.csv", Path("DHA/2025-06.csv"), out, ["csv", "xlsx"])
+    assert res["written"] == [str(Path("DHA/2025-06_scored.csv"))]
+    assert res["skipped"] and res["skipped"][0].startswith("xlsx:")
+    assert (out / "DHA" / "2025-06_scored.csv").read_bytes().startswith(b"\xef\xbb\xbf")
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""Đối chiếu phần vectơ hóa (simulate_scores / break_even_actual) với bộ chấm điểm vô hướng."""
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import kpi_core as k
+
+METHODS = {
+    "RATIO_UP": "Tăng tốt hơn",
+    "RATIO_DOWN": "Giảm tốt hơn",
+    "PASS_FAIL": "Đạt/Không đạt",
+    "RANGE": "Trong khoảng",
+    "PENALTY_FLAG": "Vượt chỉ tiêu SAIDI",
+    "PENALTY_ERR": "Sai số ±1,5%: trừ 0,04 điểm/0,1% (max 3)",
+    "MẶC ĐỊNH": "không khớp quy tắc nào",
+}
+GRID = np.round(np.concatenate([np.linspace(-3, 8, 221), np.linspace(8, 250, 243)]), 4)
+
+def _frame(rule_type):
+    rows = []
+    for plan in (1.5, 4.0, 50.0, 100.0, 0.0):
+        for unit in ("%", "kWh"):
+            for w in (0.0, 30.0):
+                rows.append({"Tên chỉ tiêu (KPI)": "KPI", "Đơn vị tính": unit, "Kế hoạch": plan, "Thực hiện": plan,
+                             "Trọng số": w, "Phương pháp đo kết quả": METHODS[rule_type],
+                             "Ngưỡng dưới": 2.0, "Ngưỡng trên": 60.0})
+    return pd.DataFrame(rows)
+
+def _scalar(row, actual):
+    r = dict(row); r["Thực hiện"] = actual
+    return k.compute_score_with_method(r)
+
+def _targets(rule_type, w):
+    if rule_type.startswith("PENALTY"):
+        return (0.0, -0.04, -0.08, -0.25, -1.0, -3.0)
+    return (0.0, 1.0, 0.5*10*w, 10*w, 15*w, 25*w)
+
+@pytest.mark.parametrize("rule_type", list(METHODS))
+def test_simulate_matches_scalar(rule_type):
+    df = _frame(rule_type)
+    assert (k.rule_params(df)["type"] == rule_type).all()
+    got = k.simulate_scores(df, np.tile(GRID, (len(df), 1)))
+    for i, row in enumerate(df.to_dict("records")):
+        for j, a in enumerate(GRID):
+            want = _scalar(row, float(a))
+            if want is None:
+                assert np.isnan(got[i, j]), (rule_type, row, a)
+            else:
+                assert abs(got[i, j] - want) <= 0.01 + 1e-9, (rule_type, row, a, got[i, j], want)
+
+@pytest.mark.parametrize("rule_type", list(METHODS))
+def test_break_even_ranges_match_scorer(rule_type):
+    df = _frame(rule_type)
+    params = k.rule_params(df)
+    assert (params["type"] == rule_type).all()
+    for i, row in enumerate(df.to_dict("records")):
+        for s in _targets(rule_type, params["w"].iat[i]):
+            iv = k.break_even_actual(df.iloc[[i]], s, params=params.iloc[[i]])["Khoảng đạt"].iat[0]
+            for a in GRID:
+                # Bỏ qua các điểm sát đầu mút (không xét đóng/mở, sai số làm tròn điểm)
+                if any(min(abs(a-lo), abs(a-hi)) < 1e-3 for lo, hi in iv): continue
+                score = _scalar(row, float(a))
+                reached = score is not None and score >= s - 1e-9
+                inside = any(lo < a < hi for lo, hi in iv)
+                assert reached == inside, (rule_type, row, s, a, score, iv)
+
+def test_penalty_err_small_plan_is_not_safe():
+    df = pd.DataFrame([{"Tên chỉ tiêu (KPI)": "Dự báo", "Đơn vị tính": "kWh", "Kế hoạch": 4.0, "Thực hiện": 4.0,
+                        "Trọng số": 0, "Phương pháp đo kết quả": "sai số ±1,5%; trừ 0,04"}])
+    iv = k.break_even_actual(df, 0.0)["Khoảng đạt"].iat[0]
+    assert not any(lo < 4.0 < hi for lo, hi in iv)
+    assert k.compute_score_with_method(df.iloc[0].to_dict()) < 0
+
+@pytest.mark.parametrize("rule_type", ["RATIO_UP", "RATIO_DOWN", "MẶC ĐỊNH"])
+def test_break_even_negative_plan(rule_type):
+    df = _frame(rule_type).assign(**{"Kế hoạch": -40.0})
+    params = k.rule_params(df)
+    grid = [a for a in np.linspace(-200, 60, 521) if a != 0]   # A = 0 chia cho 0 ở bộ chấm vô hướng
+    for i, row in enumerate(df.to_dict("records")):
+        for s in _targets(rule_type, params["w"].iat[i]):
+            iv = k.break_even_actual(df.iloc[[i]], s, params=params.iloc[[i]])["Khoảng đạt"].iat[0]
+            for a in grid:
+                if any(min(abs(a-lo), abs(a-hi)) < 1e-3 for lo, hi in iv): continue
+                score = _scalar(row, float(a))
+                assert (score is not None and score >= s - 1e-9) == any(lo < a < hi for lo, hi in iv), \
+                    (rule_type, row, s, a, score, iv)